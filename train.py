@@ -1,3 +1,4 @@
+import torch.distributed as dist
 import torchvision as tv
 from torchvision import transforms
 
@@ -5,64 +6,92 @@ from wrapper import ClassificationModelWrapper
 from pathlib import Path
 import argparse
 
-parser = argparse.ArgumentParser(prog='train.py',
-                                 description='Train a CNN model using CIFAR-10 dataset (https://www.cs.toronto.edu/~kriz/cifar.html)')
-parser.add_argument('--name', type=str, help='name of your model experiment')
-parser.add_argument('--path', default=None, type=Path, help="a path to save your model's checkpoints and history.csv file")
-parser.add_argument('--batch_size', default=32, type=int, help="a batch size for DataLoaders")
-parser.add_argument('--learning_rate', default=1e-4, type=float, help='learning rate. if the training is very slow (not time, but results),\
-                                                                       then increase it. if the model cannot converge (make loss small), try lowering it')
-parser.add_argument('--weight_decay', default=1e-4, type=float, help='L2 regularization parameter, high values try to reduce overfitting')
-parser.add_argument('--model', default='efficientnet_b0', type=str, help='the model architecture that you want to train. you can choose\
-                                                                          between efficientnet_b0, alexnet, vgg11 and vgg11_bn (https://pytorch.org/vision/stable/models.html)')
-parser.add_argument('--dataset_root', default=Path('./CIFAR-10'), type=Path, help='where to download the dataset')
-parser.add_argument('--optimizer', default='SGD', type=str, help='optimizer to train the network. you can choose between Adam and SGD')
-parser.add_argument('--epochs', default=50, type=int, help='number of epochs to train. low value can lead to underfitting, high value can lead to\
-                                                            overfitting (however, L2 regularization (weight_decay) is a technique to deal with it,\
-                                                            so you can try increasing it in case of overfitting)')
-parser.add_argument('--test_every', default=5, type=int, help='per how many epochs should your model be trained (results are being printed to the console\
-                                                               only when the model was trained!)')
-parser.add_argument('--patience', default=None, type=int, help='early stopping parameter. if test_loss have been increasing for {patience} epochs,\
-                                                                the model would stop training')
-parser.add_argument('--load_checkpoint', default=None, type=Path, help='path to your checkpoint (if you want to continue training your model from it)\
-                                                                        IMPORTANT: the model parameter should be the same as in the checkpoint')
-
-args = parser.parse_args()
-
-if args.path is None:
-    path = Path(f'./{args.name}')
-else:
-    path = args.path
-
-wrapper = ClassificationModelWrapper(args.batch_size, args.learning_rate, args.weight_decay, args.name, path)
-
-wrapper.load_model(num_classes=10, model=args.model, checkpoint=args.load_checkpoint)
-
-transform = transforms.Compose([
-      transforms.Resize((256, 256)),
-      transforms.CenterCrop((224, 224)),
-      transforms.ToTensor(),
-      transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                           std=[0.229, 0.224, 0.225])
-])
-
-train_dataset = tv.datasets.CIFAR10(
-    root=args.dataset_root,
-    train=True,
-    download=True,
-    transform=transform
-)
-
-test_dataset = tv.datasets.CIFAR10(
-    root=args.dataset_root,
-    train=False,
-    download=True,
-    transform=transform
-)
-
-wrapper.prepare_dataloaders(train_dataset, test_dataset)
-wrapper.init_optim(optimizer=args.optimizer)
-history = wrapper.train(args.epochs, args.test_every, args.patience)
-history.to_csv(path / 'history.csv')
-print(f'Done! Model checkpoints and history.csv file are in {str(Path(path))} directory. \
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'{value} should be at least 1')
+    return value
+
+
+# DataLoader workers re-import __main__ on spawn-start platforms (macOS, Windows),
+# so nothing should run at import time
+def main():
+    parser = argparse.ArgumentParser(prog='train.py',
+                                     description='Train a CNN model using CIFAR-10 dataset (https://www.cs.toronto.edu/~kriz/cifar.html)')
+    parser.add_argument('--name', type=str, help='name of your model experiment')
+    parser.add_argument('--path', default=None, type=Path, help="a path to save your model's checkpoints and history.csv file")
+    parser.add_argument('--batch_size', default=32, type=int, help="a batch size for DataLoaders")
+    parser.add_argument('--learning_rate', default=1e-4, type=float, help='learning rate. if the training is very slow (not time, but results),\
+                                                                           then increase it. if the model cannot converge (make loss small), try lowering it')
+    parser.add_argument('--weight_decay', default=1e-4, type=float, help='L2 regularization parameter, high values try to reduce overfitting')
+    parser.add_argument('--model', default='efficientnet_b0', type=str, help='the model architecture that you want to train. you can choose\
+                                                                              between efficientnet_b0, alexnet, vgg11 and vgg11_bn (https://pytorch.org/vision/stable/models.html)')
+    parser.add_argument('--dataset_root', default=Path('./CIFAR-10'), type=Path, help='where to download the dataset')
+    parser.add_argument('--optimizer', default='SGD', type=str, help='optimizer to train the network. you can choose between Adam and SGD')
+    parser.add_argument('--epochs', default=50, type=int, help='number of epochs to train. low value can lead to underfitting, high value can lead to\
+                                                                overfitting (however, L2 regularization (weight_decay) is a technique to deal with it,\
+                                                                so you can try increasing it in case of overfitting)')
+    parser.add_argument('--test_every', default=5, type=int, help='per how many epochs should your model be trained (results are being printed to the console\
+                                                                   only when the model was trained!)')
+    parser.add_argument('--patience', default=None, type=int, help='early stopping parameter. if test_loss have been increasing for {patience} epochs,\
+                                                                    the model would stop training')
+    parser.add_argument('--keep_checkpoints', default=None, type=positive_int, help='how many checkpoints with the lowest test loss to keep on disk (by default all of them are kept)')
+    parser.add_argument('--compute_train_acc', action='store_true', help='compute the accuracy on the train dataset too (disabled by default, because it slows down training)')
+    parser.add_argument('--resume_history', action='store_true', help='append to the existing history.csv in --path (continuing its epoch numbers)\
+                                                                       instead of overwriting it. use it together with --load_checkpoint')
+    parser.add_argument('--load_checkpoint', default=None, type=Path, help='path to your checkpoint (if you want to continue training your model from it)\
+                                                                            IMPORTANT: the model parameter should be the same as in the checkpoint')
+
+    args = parser.parse_args()
+
+    if args.path is None:
+        path = Path(f'./{args.name}')
+    else:
+        path = args.path
+
+    wrapper = ClassificationModelWrapper(NAME=args.name, PATH=path, LR=args.learning_rate, WEIGHT_DECAY=args.weight_decay)
+
+    wrapper.load_model(num_classes=10, model=args.model, checkpoint=args.load_checkpoint)
+
+    transform = transforms.Compose([
+          transforms.Resize((256, 256)),
+          transforms.CenterCrop((224, 224)),
+          transforms.ToTensor(),
+          transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                               std=[0.229, 0.224, 0.225])
+    ])
+
+    # with torchrun, only one process downloads the dataset, the others wait for it
+    if wrapper.is_main_process:
+        tv.datasets.CIFAR10(root=args.dataset_root, train=True, download=True)
+        tv.datasets.CIFAR10(root=args.dataset_root, train=False, download=True)
+    if dist.is_initialized():
+        dist.barrier()
+
+    train_dataset = tv.datasets.CIFAR10(
+        root=args.dataset_root,
+        train=True,
+        download=False,
+        transform=transform
+    )
+
+    test_dataset = tv.datasets.CIFAR10(
+        root=args.dataset_root,
+        train=False,
+        download=False,
+        transform=transform
+    )
+
+    wrapper.prepare_dataloaders(train_dataset, test_dataset, BATCH_SIZE=args.batch_size)
+    wrapper.init_optim(optimizer=args.optimizer)
+    wrapper.train(args.epochs, args.test_every, args.patience, KEEP_CHECKPOINTS=args.keep_checkpoints,
+                  COMPUTE_TRAIN_ACC=args.compute_train_acc, RESUME_HISTORY=args.resume_history)
+    if wrapper.is_main_process:
+        print(f'Done! Model checkpoints and history.csv file are in {str(Path(path))} directory. \
 The names of checkpoints are following the pattern EPOCH_TESTLOSS_TESTACCURACY')
+
+    wrapper.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,71 @@
 import torch
 from torch import nn
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 import torchvision as tv
 from torchmetrics import Accuracy
 import pandas as pd
+import os
+import sys
+import warnings
+import csv
+from contextlib import nullcontext
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
 from pathlib import Path
 from tqdm import tqdm
 
+def compile_supported():
+    '''
+    Whether torch.compile can run with the installed torch and Python versions \
+    (torch 2.0.x doesn't support Python 3.11+)
+    '''
+
+    return torch.__version__ >= '2.1' or sys.version_info < (3, 11)
+
+
+def loss_and_preds(logits, y, criterion):
+    '''
+    Compute the loss and the predicted classes from the same logits. Under torch.compile \
+    both row reductions (log-softmax max and argmax) are fused into one pass over the logits
+    '''
+
+    return criterion(logits, y), logits.argmax(dim=1)
+
+
+class FrozenSequential(nn.Sequential):
+
+    '''
+    nn.Sequential that runs its forward pass under torch.no_grad, so autograd \
+    doesn't store activations for the frozen layers. Keeps the same state_dict keys as nn.Sequential
+    '''
+
+    def forward(self, x):
+        with torch.no_grad():
+            return super().forward(x)
+
+
+class ClassifierHead(nn.Sequential):
+
+    '''
+    Dropout + Linear classifier. The dropout is skipped entirely in eval mode \
+    instead of dispatching a no-op module. Keeps the same state_dict keys as nn.Sequential(nn.Dropout, nn.Linear)
+    '''
+
+    def __init__(self, in_features: int, num_classes: int, p: float=0.2):
+        super().__init__(
+            nn.Dropout(p=p),
+            nn.Linear(in_features, num_classes)
+        )
+
+    def forward(self, x):
+        if self.training:
+            x = F.dropout(x, p=self[0].p, training=True)
+        return self[1](x)
+
+
 class ClassificationModelWrapper:
 
     '''
@@ -39,7 +98,7 @@ class ClassificationModelWrapper:
         __init__(BATCH_SIZE, LR, WEIGHT_DECAY, NAME, PATH)
             initializing basic hyperparameters
 
-        load_model(model: Literal['efficientnet_b0', 'alexnet', 'vgg11', 'vgg11_bn']='efficientnet_b0')
+        load_model(num_classes, model: Literal['efficientnet_b0', 'alexnet', 'vgg11', 'vgg11_bn']='efficientnet_b0', checkpoint=None, compile=True)
             load pre-trained model from torchvision.models for fine-tuning
 
         prepare_dataloaders(train_dataset, test_dataset)
@@ -48,8 +107,11 @@ class ClassificationModelWrapper:
         init_optim(optimizer: Literal['SGD', 'Adam']='SGD')
             initialize optimizer, criterion and accuracy metric function
 
-        train(EPOCHS, TEST_EVERY, PATIENCE)
+        train(EPOCHS, TEST_EVERY, PATIENCE, EMPTY_CACHE_EVERY, KEEP_CHECKPOINTS, COMPUTE_TRAIN_ACC, VERBOSE, RESUME_HISTORY)
             train the model. PATIENCE - early stopping parameter
+
+        cleanup()
+            wait for the pending checkpoint and tear down the distributed process group (if any)
     '''
 
     def __init__(self, NAME: str=None, PATH: str|Path=None, LR: float=1e-3, WEIGHT_DECAY: float=1e-4):
@@ -68,12 +130,49 @@ class ClassificationModelWrapper:
         self.PATH = Path(PATH)
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+        # launched with torchrun -> one process per GPU
+        if 'LOCAL_RANK' in os.environ:
+            self._init_ddp()
+        self.is_main_process = not dist.is_initialized() or dist.get_rank() == 0
+
+        # input shapes are fixed, so let cuDNN pick the fastest conv algorithms once and cache them
+        # (torch.compile specializes its kernels on shapes anyway). TF32 is used for the remaining fp32 matmuls
+        if self.device.type == 'cuda':
+            torch.backends.cudnn.benchmark = True
+            torch.set_float32_matmul_precision('high')
+
+        # mixed precision (CUDA only). bf16 has the same range as fp32, so the GradScaler is only needed for fp16
+        self.use_amp = self.device.type == 'cuda'
+        # the disabled (CPU) autocast context still checks its dtype, and CPU autocast only accepts bf16
+        self.amp_dtype = torch.float16 if self.use_amp and not torch.cuda.is_bf16_supported() else torch.bfloat16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp and self.amp_dtype == torch.float16)
+        self._loss_and_preds = loss_and_preds
+
+        # checkpoints are written in the background, one at a time (see _save_checkpoint)
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self._save_future = None
+        self._saved_checkpoints = []  # max-heap of (-test_loss, path)
+        self._ckpt_fmt = '{epoch}_{loss:.4f}_{acc:.4f}.pth'
+
         self.PATH.mkdir(parents=True, exist_ok=True)
 
 
+    def _init_ddp(self):
+        '''
+        Initialize the process group for DistributedDataParallel training and \
+        bind this process to its GPU (internal method)
+        '''
+
+        dist.init_process_group('nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        self.device = torch.device('cuda', local_rank)
+
+
     def load_model(self, num_classes: int,
                    model: Literal['efficientnet_b0', 'alexnet', 'vgg11', 'vgg11_bn']='efficientnet_b0',
-                   checkpoint: Path|str=None):
+                   checkpoint: Path|str=None,
+                   compile: bool=True):
         '''
         Load a pre-trained model from torchvision.models. If you want to build your own architecture \
         - you can just set your model to self.model attribute.
@@ -81,6 +180,8 @@ class ClassificationModelWrapper:
         num_classes - the number of classes in your dataset
         model - the model architecture to load form the server. Possible options: efficientnet_b0, alexnet, vgg11, vgg11_bn.
         checkpoint - path-like object to the .pth checkpoint.
+        compile - whether to wrap the model with torch.compile (CUDA only, and only where compile_supported()). \
+        set it to False to debug graph breaks.
         '''
         
         if model == 'efficientnet_b0':
@@ -101,16 +202,39 @@ class ClassificationModelWrapper:
         # did't test if it works with models except efficientnet
         for parameter in self.model.features.parameters():  
             parameter.requires_grad = False
+        self.model.features = FrozenSequential(*self.model.features)
 
-        self.model.classifier = nn.Sequential(
-            nn.Dropout(p=0.2),
-            nn.Linear(1280, num_classes)
-        )
+        self.model.classifier = ClassifierHead(1280, num_classes, p=0.2)
 
-        self.model = self.model.to(self.device)
+        # NHWC layout lets cuDNN use its tensor-core conv kernels (inputs are converted in train/test steps)
+        self.model = self.model.to(self.device, memory_format=torch.channels_last)
 
+        # load the checkpoint before compiling, so its keys don't need the `_orig_mod.` prefix.
+        # the storages are memory-mapped on CPU and copied straight into the (channels_last) parameters on the device
         if checkpoint is not None:
-            self.model.load_state_dict(torch.load(checkpoint, map_location=self.device))
+            load_kwargs = dict(map_location='cpu', weights_only=True)
+            if torch.__version__ >= '2.1':
+                load_kwargs.update(mmap=True)
+            self.model.load_state_dict(torch.load(checkpoint, **load_kwargs))
+
+        if dist.is_initialized():
+            self.model = DDP(self.model, device_ids=[self.device.index])
+
+        if compile and torch.cuda.is_available():
+            if compile_supported():
+                self.model = torch.compile(self.model, mode='reduce-overhead')
+                self._loss_and_preds = torch.compile(loss_and_preds)
+            else:
+                warnings.warn('torch.compile is not supported with this torch/Python version, the model runs in eager mode')
+
+
+    def _unwrapped_model(self):
+        '''
+        Return the underlying nn.Module of self.model (internal method)
+        '''
+
+        model = getattr(self.model, '_orig_mod', self.model)
+        return model.module if isinstance(model, DDP) else model
 
 
     def prepare_dataloaders(self,
@@ -123,6 +247,10 @@ class ClassificationModelWrapper:
         train_dataset - train dataset
         test_dataset - test dataset
         BATCH_SIZE - the batch size you want to use
+
+        In distributed training the datasets are sharded with DistributedSampler. If the test dataset \
+        isn't divisible by the number of processes, a few test samples are duplicated to pad the shards, \
+        so the test loss and accuracy can differ slightly from a single-GPU run
         '''
 
         self.train_dataset = train_dataset
@@ -130,8 +258,29 @@ class ClassificationModelWrapper:
         self.BATCH_SIZE = BATCH_SIZE
 
         self.num_classes = len(self.train_dataset.classes)
-        self.train_loader = torch.utils.data.DataLoader(self.train_dataset, batch_size=self.BATCH_SIZE)
-        self.test_loader = torch.utils.data.DataLoader(self.test_dataset, batch_size=self.BATCH_SIZE)
+
+        # the CPUs are shared by all processes on this node
+        num_workers = (os.cpu_count() or 0) // 2
+        if dist.is_initialized():
+            num_workers //= int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+
+        # pinned memory lets the host-to-device copies in train/test steps run with non_blocking=True
+        loader_kwargs = dict(batch_size=self.BATCH_SIZE,
+                             pin_memory=(self.device.type == 'cuda'),
+                             num_workers=num_workers)
+        if num_workers > 0:
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=2)
+
+        # every process gets its own shard of the datasets
+        train_sampler, test_sampler = None, None
+        if dist.is_initialized():
+            train_sampler = torch.utils.data.distributed.DistributedSampler(self.train_dataset, shuffle=True)
+            test_sampler = torch.utils.data.distributed.DistributedSampler(self.test_dataset, shuffle=False)
+
+        self.train_loader = torch.utils.data.DataLoader(self.train_dataset, sampler=train_sampler, **loader_kwargs)
+        self.test_loader = torch.utils.data.DataLoader(self.test_dataset, sampler=test_sampler, **loader_kwargs)
+        self._num_train_batches = len(self.train_loader)
+        self._num_test_batches = len(self.test_loader)
 
 
     def init_optim(self, optimizer: Literal['SGD', 'Adam']='SGD'):
@@ -156,31 +305,41 @@ class ClassificationModelWrapper:
         Perform a train step (internal method)
         '''
 
-        train_loss, train_acc = 0, 0
+        # accumulate on the device, so there is only one GPU -> CPU sync per epoch
+        train_loss = torch.zeros((), device=self.device)
+        if self.COMPUTE_TRAIN_ACC:
+            self.acc_fn.reset()
 
         self.model.train()
         for train_X, train_y in self.train_loader:
-            train_X = train_X.to(self.device)
-            train_y = train_y.to(self.device)
-
-            logits = self.model(train_X)
-            preds = torch.softmax(logits, dim=1).argmax(dim=1)
-
-            train_loss_batch = self.criterion(logits, train_y)
-            train_loss += train_loss_batch.item()
-            train_acc_batch = self.acc_fn(preds, train_y)
-            train_acc += train_acc_batch.item()
-
-            self.optimizer.zero_grad()
-            train_loss_batch.backward()
-            self.optimizer.step()
-
-            torch.cuda.empty_cache()
-            train_X = train_X.detach().cpu()
-            train_y = train_y.detach().cpu()
-
-        train_loss /= len(self.train_loader)
-        train_acc /= len(self.train_loader)
+            train_X = train_X.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+            train_y = train_y.to(self.device, non_blocking=True)
+
+            self.optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                logits = self.model(train_X)
+                if self.COMPUTE_TRAIN_ACC:
+                    train_loss_batch, preds = self._loss_and_preds(logits, train_y, self.criterion)
+                else:
+                    train_loss_batch = self.criterion(logits, train_y)
+
+            train_loss += train_loss_batch.detach()
+            if self.COMPUTE_TRAIN_ACC:
+                self.acc_fn.update(preds, train_y)
+
+            self.scaler.scale(train_loss_batch).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+
+        train_loss /= self._num_train_batches
+        if dist.is_initialized():
+            dist.all_reduce(train_loss)
+            train_loss /= dist.get_world_size()
+        train_loss = train_loss.item()
+        train_acc = float('nan')
+        if self.COMPUTE_TRAIN_ACC:
+            train_acc = self.acc_fn.compute().item()
+            self.acc_fn.reset()
 
         return train_loss, train_acc
     
@@ -190,75 +349,184 @@ class ClassificationModelWrapper:
         Perform a test step (internal method)
         '''
 
-        test_loss, test_acc = 0, 0
+        # accumulate on the device, so there is only one GPU -> CPU sync per epoch
+        test_loss = torch.zeros((), device=self.device)
+        self.acc_fn.reset()
 
         with torch.inference_mode():
             self.model.eval()
             for test_X, test_y in self.test_loader:
-                test_X = test_X.to(self.device)
-                test_y = test_y.to(self.device)
+                test_X = test_X.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+                test_y = test_y.to(self.device, non_blocking=True)
 
-                logits = self.model(test_X)
-                preds = torch.softmax(logits, dim=1).argmax(dim=1)
+                with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                    logits = self.model(test_X)
+                    test_loss_batch, preds = self._loss_and_preds(logits, test_y, self.criterion)
 
-                test_loss_batch = self.criterion(logits, test_y)
-                test_loss += test_loss_batch.item()
-                test_acc_batch = self.acc_fn(preds, test_y)
-                test_acc += test_acc_batch.item()
+                test_loss += test_loss_batch.detach()
+                self.acc_fn.update(preds, test_y)
 
-                torch.cuda.empty_cache()
-                test_X = test_X.detach().cpu()
-                test_y = test_y.detach().cpu()
-
-        test_loss = test_loss / len(self.test_loader)
-        test_acc = test_acc / len(self.test_loader)
+        test_loss /= self._num_test_batches
+        if dist.is_initialized():
+            dist.all_reduce(test_loss)
+            test_loss /= dist.get_world_size()
+        test_loss = test_loss.item()
+        test_acc = self.acc_fn.compute().item()
+        self.acc_fn.reset()
 
         if self.PATIENCE is not None:
             if (test_loss_previous < test_loss) and (self.epoch != 0):
                 self.patience_curr += 1
-                print(f'Test loss increased | {test_loss_previous} => {test_loss} | {self.patience_curr}/{self.PATIENCE}')
+                if self.is_main_process and self.VERBOSE:
+                    print(f'Test loss increased | {test_loss_previous} => {test_loss} | {self.patience_curr}/{self.PATIENCE}')
                 if self.patience_curr == self.PATIENCE:
                     self.patience_ended = True
 
             elif test_loss_previous > test_loss:
                 self.patience_curr = 0
-                torch.save(self.model.state_dict(), self.PATH / f'{self.epoch}_{test_loss}_{test_acc}.pth')
+                if self.is_main_process:
+                    self._save_checkpoint(self.PATH / self._ckpt_fmt.format(epoch=self.epoch, loss=test_loss, acc=test_acc), test_loss)
 
         return test_loss, test_acc
 
 
-    def train(self, EPOCHS, TEST_EVERY, PATIENCE=None):
+    def _save_checkpoint(self, path: Path, test_loss: float):
+        '''
+        Copy the model's state_dict to CPU and write it to `path` in a background thread. \
+        If KEEP_CHECKPOINTS is set, only the checkpoints with the lowest test loss are kept (internal method)
+        '''
+
+        # re-raise the error of the previous save (if any) instead of losing it
+        if self._save_future is not None:
+            self._save_future.result()
+
+        heapq.heappush(self._saved_checkpoints, (-test_loss, path))
+        stale = []
+        if self.KEEP_CHECKPOINTS is not None:
+            while len(self._saved_checkpoints) > self.KEEP_CHECKPOINTS:
+                stale.append(heapq.heappop(self._saved_checkpoints)[1])
+
+        # don't write this checkpoint at all if it is already worse than the KEEP_CHECKPOINTS best ones
+        save_model = path not in stale
+        if not save_model:
+            stale.remove(path)
+
+        cpu_state, copied = None, None
+        if save_model:
+            cpu_state = {k: v.detach().to('cpu', non_blocking=True) for k, v in self._unwrapped_model().state_dict().items()}
+            if self.device.type == 'cuda':
+                copied = torch.cuda.Event()
+                copied.record()
+
+        def save():
+            if copied is not None:
+                copied.synchronize()
+            if save_model:
+                torch.save(cpu_state, path)
+            for stale_path in stale:
+                stale_path.unlink(missing_ok=True)
+
+        self._save_future = self.save_executor.submit(save)
+
+
+    def train(self, EPOCHS, TEST_EVERY, PATIENCE=None, EMPTY_CACHE_EVERY=None, KEEP_CHECKPOINTS=None, COMPUTE_TRAIN_ACC=False,
+              VERBOSE=True, RESUME_HISTORY=False):
         '''
-        Train a model
+        Train a model. The results of every tested epoch are written to PATH/history.csv as soon as they are computed
 
         EPOCHS - number of epochs to train
         TEST_EVERY - per how many epochs the model should be tested (and results should be printed)
         PATIENCE - early stopping parameter. if test_loss have been increasing for {patience} epochs, the model will stop training
+        EMPTY_CACHE_EVERY - per how many epochs the CUDA cache should be emptied, at least 1 (if None, it is never emptied). \
+        prefer PYTORCH_CUDA_ALLOC_CONF=expandable_segments:True or a smaller batch size if you run out of memory
+        KEEP_CHECKPOINTS - how many checkpoints with the lowest test loss to keep on disk, at least 1 (if None, all of them are kept)
+        COMPUTE_TRAIN_ACC - whether to compute the accuracy on the train dataset (if False, train_acc is NaN in history)
+        VERBOSE - whether to print the results of every tested epoch (and test loss increases)
+        RESUME_HISTORY - whether to continue an existing history.csv (written by this method) instead of overwriting it. \
+        the epochs are numbered from the last epoch in it. self.history only contains the epochs of this run
         '''
 
-        results = []
+        if EMPTY_CACHE_EVERY is not None and EMPTY_CACHE_EVERY < 1:
+            raise RuntimeError('Incorrect `EMPTY_CACHE_EVERY` parameter. It should be at least 1.')
+        if KEEP_CHECKPOINTS is not None and KEEP_CHECKPOINTS < 1:
+            raise RuntimeError('Incorrect `KEEP_CHECKPOINTS` parameter. It should be at least 1.')
 
         self.PATIENCE = PATIENCE
+        self.KEEP_CHECKPOINTS = KEEP_CHECKPOINTS
+        self.COMPUTE_TRAIN_ACC = COMPUTE_TRAIN_ACC
+        self.VERBOSE = VERBOSE
         self.patience_curr = 0
         self.patience_ended = False
         test_loss = 0
 
-        for epoch in tqdm(range(EPOCHS)):
-            print('')
-            self.epoch = epoch
-            if self.patience_ended:
-                print(f'Early stopping...')
-                break
+        results = []
+        columns = ['epoch', 'train_loss', 'train_acc', 'test_loss', 'test_acc']
+        history_path = self.PATH / 'history.csv'
+        start_epoch = 0
+
+        # continue the epoch numbering and the early stopping from the previous run
+        resume = RESUME_HISTORY and history_path.exists() and history_path.stat().st_size > 0
+        if resume:
+            previous_history = pd.read_csv(history_path)
+            if list(previous_history.columns) != columns:
+                raise RuntimeError(f'Cannot resume {history_path}: its columns {list(previous_history.columns)} don\'t match {columns}.')
+            if len(previous_history) > 0:
+                start_epoch = int(previous_history['epoch'].iloc[-1]) + 1
+                test_loss = float(previous_history['test_loss'].iloc[-1])
+
+        # only the main process logs, saves checkpoints and writes history.csv
+        log = print if self.is_main_process and VERBOSE else (lambda *args, **kwargs: None)
+
+        with (open(history_path, 'a' if resume else 'w', newline='') if self.is_main_process else nullcontext()) as history_file:
+            if history_file is not None:
+                history_writer = csv.writer(history_file)
+                if not resume:
+                    history_writer.writerow(columns)
+
+            for epoch in tqdm(range(start_epoch, start_epoch + EPOCHS), disable=not self.is_main_process):
+                log('')
+                self.epoch = epoch
+                if self.patience_ended:
+                    if self.is_main_process:
+                        print(f'Early stopping...')
+                    break
+
+                if isinstance(self.train_loader.sampler, torch.utils.data.distributed.DistributedSampler):
+                    self.train_loader.sampler.set_epoch(epoch)
+
+                train_loss, train_acc = self._train_step()
+
+                if self.epoch % TEST_EVERY == 0:
+                    test_loss_previous = test_loss
+                    test_loss, test_acc = self._test_step(test_loss_previous)
+
+                    log(f'Epoch {epoch}, train loss {train_loss:.5f}, train accuracy {train_acc:.5f}, test loss {test_loss:.5f}, test accuracy {test_acc:.5f}')
+                    results.append([epoch, train_loss, train_acc, test_loss, test_acc])
+                    if history_file is not None:
+                        history_writer.writerow([epoch, train_loss, train_acc, test_loss, test_acc])
+                        history_file.flush()
+
+                if EMPTY_CACHE_EVERY is not None and self.epoch % EMPTY_CACHE_EVERY == 0:
+                    torch.cuda.empty_cache()
+                log('\n')
+
+        # wait for the last checkpoint to be written
+        if self._save_future is not None:
+            self._save_future.result()
+
+        self.history = pd.DataFrame(results, columns=columns)
+        return self.history
 
-            train_loss, train_acc = self._train_step()
 
-            if self.epoch % TEST_EVERY == 0:
-                test_loss_previous = test_loss
-                test_loss, test_acc = self._test_step(test_loss_previous)
+    def cleanup(self):
+        '''
+        Wait for the pending checkpoint to be written and destroy the distributed process group (if any). \
+        Call it when you are done with the wrapper
+        '''
 
-                print(f'Epoch {epoch}, train loss {train_loss:.5f}, train accuracy {train_acc:.5f}, test loss {test_loss:.5f}, test accuracy {test_acc:.5f}')
-                results.append([epoch, train_loss, train_acc, test_loss, test_acc])
-            print('\n')
+        self.save_executor.shutdown(wait=True)
+        if self._save_future is not None:
+            self._save_future.result()
 
-        self.history = pd.DataFrame(results, columns=['epoch', 'train_loss', 'train_acc', 'test_loss', 'test_acc'])
-        return self.history
+        if dist.is_initialized():
+            dist.destroy_process_group()